@@ -2,15 +2,86 @@
 """Tool for creating lyric books from OpenLyrics XML files."""
 
 import argparse
-import tomli
 from pathlib import Path
 import logging
 import shutil
-from os import listdir
+import os
 import subprocess
-import jinja2
-import xml.etree.ElementTree as ET
+import threading
+from typing import TYPE_CHECKING, NamedTuple
 import re
+import hashlib
+import json
+import operator
+import pickle
+from collections import ChainMap
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+
+# jinja2, lxml and tomllib are slow to import, so they are imported where they
+# are used. Runs that don't need them, such as --help, don't pay for them.
+if TYPE_CHECKING:
+    import jinja2
+
+# Upper bound on worker threads. Each job holds several file descriptors open,
+# so keep this bounded on machines with many cores.
+MAX_WORKERS = min(32, os.cpu_count() or 1)
+
+# Splits an author index entry into individual names.
+AUTHOR_SPLIT_RE = re.compile(r" and |[^a-zA-Z~. ]+")
+
+# Write buffer size for the generated SBD song file.
+SONGFILE_BUFFER_SIZE = 256 * 1024
+
+# Buffer size for copying files.
+COPY_BUFFER_SIZE = 1024 * 1024
+shutil.COPY_BUFSIZE = COPY_BUFFER_SIZE
+
+# LaTeX songs markup for the parts of each song.
+BEGIN_VERSE = "\\beginverse\n"
+END_VERSE = "\n\\endverse\n"
+BEGIN_CHORUS = "\\beginchorus\n"
+END_CHORUS = "\n\\endchorus\n"
+END_SONG = "\\endsong\n\n"
+
+# Sort key for the song entries in the author index.
+SONG_KEY = operator.attrgetter("songnum")
+
+# Fields required at the top level of the config file, and for each type of
+# output format.
+REQUIRED_CONFIG_FIELDS = frozenset(("songbook", "output_formats"))
+FORMAT_REQUIRED_FIELDS = {
+    "html": frozenset(("template", "output_dir", "output_file")),
+    "pdf": frozenset(("output_dir", "output_file")),
+    "epub": frozenset(("output_dir", "output_file")),
+}
+
+# Directory for cached, validated config files. An empty XDG_CACHE_HOME is
+# treated as unset.
+CONFIG_CACHE_DIR = Path(
+    os.environ.get("XDG_CACHE_HOME") or Path.home().joinpath(".cache")
+).joinpath("openlyric_bookmaker")
+
+# Namespace map for OpenLyrics song files.
+OL_NAMESPACE = "http://openlyrics.info/namespace/2009/song"
+OL_NS = {"ol": OL_NAMESPACE}
+
+
+class SongRef(NamedTuple):
+    """A song in the author index."""
+
+    songnum: int
+    link: str
+
+
+class TitleRef(NamedTuple):
+    """A song title in the title index. alt is set for alternate titles."""
+
+    title: str
+    songnum: str
+    link: str
+    alt: bool
 
 
 class SongBookMaker:
@@ -18,7 +89,7 @@ class SongBookMaker:
         self,
         songbook_config: dict,
         output_formats: list[dict] = [],
-        output_dir: Path = "output",
+        output_dir: Path = Path("output"),
         sections: dict[str, dict] = None,
         base_path: Path = None,  # base path for input files that are not absolute
         clean: bool = False,
@@ -31,6 +102,16 @@ class SongBookMaker:
         self.clean = clean
         self.songfile = "songfile.sbd"
         self.build_root = base_path.joinpath(Path("build"))
+        # Jinja2 environments, keyed by template directory.
+        self._jinja_envs = {}
+        self.build_cache = ".build_cache.json"
+        # Prepared LaTeX builds, keyed by a hash of their inputs, and the build
+        # directories that have had their indices created during this run.
+        self._latex_builds = {}
+        self._indexed_builds = set()
+        # Converted SBD entries, keyed by song file. Songs that appear in more
+        # than one section, or in more than one output, are only parsed once.
+        self.parsed_cache: dict[Path, str] = {}
 
         # Sort the sections by the order field, if present.
         if self.sections is not None:
@@ -112,9 +193,10 @@ class SongBookMaker:
                         stylesheet,
                         output_dir.joinpath(stylesheet.name),
                         dirs_exist_ok=True,
+                        copy_function=fast_copy,
                     )
                 else:
-                    shutil.copy(stylesheet, output_dir)
+                    fast_copy(stylesheet, output_dir)
 
         # Copy images. These are optional, and are a list of files and directories.
         # Directories are copied recursively, preserving the directory structure.
@@ -129,199 +211,307 @@ class SongBookMaker:
                         image,
                         output_dir.joinpath(image.name),
                         dirs_exist_ok=True,
+                        copy_function=fast_copy,
                     )
                 else:
-                    shutil.copy(image, output_dir)
-        # Create HTML files from input files for each section using xsltproc
+                    fast_copy(image, output_dir)
+        # Create HTML files from input files for each section.
+        self._make_html_songs(
+            output_dir, self.base_path.joinpath(html_config["song_xslt"])
+        )
+
+    def _make_html_songs(self, output_dir: Path, song_xslt: Path):
+        """Create an HTML file for every song with libxslt, through lxml.
+        The stylesheet is compiled once per worker thread rather than once per
+        song, and libxslt releases the GIL, so the songs are transformed
+        concurrently."""
+        from lxml import etree
+
+        song_files = []
+        output_files = []
         for section_name, section in self.sections.items():
             logging.debug(f"Creating HTML files for section {section_name}")
             section_output_dir = output_dir.joinpath(section_name)
             section_output_dir.mkdir(parents=True, exist_ok=True)
             for song_file in section["files"]:
-                logging.debug(f"Creating HTML file for {song_file}")
-                output_file = section_output_dir.joinpath(song_file.stem + ".html")
-                xsltproc_args = [
-                    "xsltproc",
-                    "--output",
-                    output_file,
-                    self.base_path.joinpath(html_config["song_xslt"]),
-                    song_file,
-                ]
-                logging.debug(f"Running xsltproc with args: {xsltproc_args}")
-                xsltproc_result = subprocess.run(xsltproc_args)
-                if xsltproc_result.returncode != 0:
-                    raise RuntimeError(
-                        f"xsltproc failed with return code {xsltproc_result.returncode}"
-                    )
+                song_files.append(song_file)
+                output_files.append(
+                    section_output_dir.joinpath(song_file.stem + ".html")
+                )
+
+        # Compiled stylesheets aren't shared between threads, so each worker
+        # compiles its own.
+        local = threading.local()
+
+        def transform_song(song_file: Path, output_file: Path):
+            logging.debug(f"Creating HTML file {output_file} for {song_file}")
+            if not hasattr(local, "transform"):
+                local.transform = etree.XSLT(etree.parse(str(song_xslt)))
+            try:
+                with open(song_file, "rb") as song:
+                    result = local.transform(etree.parse(song))
+            except FileNotFoundError as e:
+                raise FileNotFoundError(f"Input file not found: {e.filename}") from e
+            except (etree.XMLSyntaxError, etree.XSLTApplyError) as e:
+                raise RuntimeError(f"XSLT transform failed for {song_file}: {e}") from e
+            # Serialize using the stylesheet's xsl:output settings.
+            output_file.write_bytes(bytes(result))
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Consume the results so that any exceptions are raised here.
+            list(executor.map(transform_song, song_files, output_files))
 
     def make_pdf_output(self, pdf_config: dict):
         """Create PDF output.
         This is done by formatting and joining several LaTeX files and then
         running pdflatex on the result."""
 
-        # Create the output and build directories
+        # Create the output directory
         output_dir = self.output_dir.joinpath(pdf_config["output_dir"])
         output_dir.mkdir(parents=True, exist_ok=True)
-        build_dir = self.build_root.joinpath(pdf_config["output_dir"])
-        build_dir.mkdir(parents=True, exist_ok=True)
 
-        # Render the template files and copy the result to the build directory.
-        template_vars = (
-            pdf_config
-            | pdf_config.get("render_variables", {})
-            | self.songbook_config
-            | {"sections": self.sections}
+        # Get the output filename
+        output_filename = (
+            (pdf_config["output_file"])
+            if "output_file" in pdf_config
+            else pdf_config["songbook_template"]
+        )
+
+        # Prepare the LaTeX build.
+        build_dir, fingerprint = self._prepare_latex_build(
+            self.build_root.joinpath(pdf_config["output_dir"]),
+            pdf_config,
+            output_filename,
         )
-        for var in template_vars:
-            logging.debug(f"Template variable {var}: {template_vars[var]}")
+        output_file = build_dir.joinpath(Path(output_filename).stem + ".pdf")
 
-        # Render all the templates from the template directory to the build directory.
+        if self._latex_build_is_current(build_dir, fingerprint, output_file):
+            logging.info(f"{output_file} is up to date, skipping pdflatex")
+        else:
+            # Create the indices, then rerun pdflatex now that we have them.
+            self._make_latex_index_pass(build_dir, pdf_config, output_filename)
+            self._run_pdflatex(build_dir, pdf_config, output_filename, rerun=True)
+            self._save_latex_build_fingerprint(build_dir, fingerprint, output_file)
+
+        # Copy the output file to the output directory
+        fast_copy(output_file, output_dir)
+
+    def _prepare_latex_build(
+        self, build_dir: Path, config: dict, jobname: str
+    ) -> tuple[Path, str]:
+        """Prepare a LaTeX build for the PDF and EPUB outputs.
+        This renders the templates, copies the style file and images and
+        creates the SBD file.
+
+        Returns the directory containing the build, and a fingerprint of all of
+        its inputs. If another output format has already prepared a build from
+        the same inputs during this run, its build directory is returned and
+        none of the work is repeated."""
+        # Render all the templates from the template directory.
         # Get a list of all of the files in the template directory, excluding the
         # style file.
-        template_dir = self.base_path.joinpath(pdf_config["template_dir"])
-        template_files = listdir(template_dir)
+        template_vars = self._build_template_vars(config)
+        template_dir = self.base_path.joinpath(config["template_dir"])
+        template_files = os.listdir(template_dir)
         logging.debug(f"Template files: {template_files}")
         template_files = [
             Path(template_dir).joinpath(f)
             for f in template_files
-            if Path(f).name != Path(pdf_config["songbook_style"]).name
+            if Path(f).name != Path(config["songbook_style"]).name
         ]
+        rendered_templates = {}
         for template in template_files:
-            self._render_template(
-                template,
-                build_dir,
-                template_vars,
-            )
+            rendered = self._render_template(template, template_vars)
+            if rendered is not None:
+                rendered_templates[template.name] = rendered
+
+        # Check for a build from the same inputs.
+        fingerprint = hashlib.blake2b()
+        for name, rendered in sorted(rendered_templates.items()):
+            fingerprint.update(f"{name}\0{rendered}\0".encode())
+        for field in ("songbook_style", "image_dir", "sbd_header", "songbook_template"):
+            fingerprint.update(f"{field}\0{config.get(field)}\0".encode())
+        fingerprint.update(f"jobname\0{jobname}\0".encode())
+        build_key = fingerprint.hexdigest()
+        if build_key in self._latex_builds:
+            shared_dir, shared_fingerprint = self._latex_builds[build_key]
+            logging.info(f"Reusing LaTeX build in {shared_dir} for {build_dir}")
+            return shared_dir, shared_fingerprint
+
+        # Write the rendered templates to the build directory.
+        build_dir.mkdir(parents=True, exist_ok=True)
+        for name, rendered in rendered_templates.items():
+            with open(build_dir.joinpath(name), "w") as output:
+                output.write(rendered)
 
         # Copy the songs.sty file to the build directory
-        shutil.copy(
-            self.base_path.joinpath(pdf_config["songbook_style"]),
+        style_file = fast_copy(
+            self.base_path.joinpath(config["songbook_style"]),
             build_dir,
         )
+        fingerprint.update(style_file.read_bytes())
 
         # Copy the images directory to the build directory, if present.
-        if "image_dir" in pdf_config:
-            shutil.copytree(
-                self.base_path.joinpath(pdf_config["image_dir"]),
-                build_dir.joinpath(pdf_config["image_dir"]),
+        # Images are fingerprinted by their size and modification time.
+        if "image_dir" in config:
+            image_dir = shutil.copytree(
+                self.base_path.joinpath(config["image_dir"]),
+                build_dir.joinpath(config["image_dir"]),
                 dirs_exist_ok=True,
+                copy_function=fast_copy,
             )
+            for image in sorted(Path(image_dir).rglob("*")):
+                stat = image.stat()
+                fingerprint.update(
+                    f"{image}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode()
+                )
 
         # Create the SBD file from the input files.
-        self._make_songfile(build_dir, pdf_config)
-        # Get the output filename
-        output_filename = (
-            (pdf_config["output_file"])
-            if "output_file" in pdf_config
-            else pdf_config["songbook_template"]
+        self._make_songfile(build_dir, config)
+        fingerprint.update(build_dir.joinpath(self.songfile).read_bytes())
+
+        fingerprint = fingerprint.hexdigest()
+        self._latex_builds[build_key] = (build_dir, fingerprint)
+        return build_dir, fingerprint
+
+    def _make_latex_index_pass(self, build_dir: Path, config: dict, jobname: str):
+        """Run pdflatex once to create the sxd files, and then create the index
+        files from them. This is only done once per build directory per run."""
+        if build_dir in self._indexed_builds:
+            return
+        # Run pdflatex on the main file to create the sxd files.
+        self._run_pdflatex(build_dir, config, jobname)
+
+        # Create the index files.
+        self._make_latex_indices(build_dir)
+        self._indexed_builds.add(build_dir)
+
+    def _latex_build_is_current(
+        self, build_dir: Path, fingerprint: str, output_file: Path
+    ) -> bool:
+        """Check whether output_file was built from inputs with the given
+        fingerprint by a previous run, and still exists."""
+        try:
+            with open(build_dir.joinpath(self.build_cache), "r") as cache:
+                fingerprints = json.load(cache)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return (
+            fingerprints.get(output_file.name) == fingerprint and output_file.exists()
         )
 
-        # Run pdflatex on the main file.
+    def _save_latex_build_fingerprint(
+        self, build_dir: Path, fingerprint: str, output_file: Path
+    ):
+        """Record the fingerprint of the inputs output_file was built from."""
+        cache_file = build_dir.joinpath(self.build_cache)
+        try:
+            with open(cache_file, "r") as cache:
+                fingerprints = json.load(cache)
+        except (FileNotFoundError, json.JSONDecodeError):
+            fingerprints = {}
+        fingerprints[output_file.name] = fingerprint
+        with open(cache_file, "w") as cache:
+            json.dump(fingerprints, cache, indent=2)
+
+    def _run_pdflatex(
+        self, build_dir: Path, config: dict, jobname: str, rerun: bool = False
+    ):
+        """Run pdflatex on the main file of the LaTeX build."""
         pdflatex_args = [
             "pdflatex",
-            f"-jobname={output_filename}",
+            f"-jobname={jobname}",
             "-halt-on-error",
-            Path(pdf_config["songbook_template"]).name,
+            Path(config["songbook_template"]).name,
         ]
-        logging.debug(f"Running pdflatex with args: {pdflatex_args}")
-        pdflatex_result = subprocess.run(pdflatex_args, cwd=build_dir)
-        if pdflatex_result.returncode != 0:
-            raise RuntimeError(
-                f"pdflatex failed with return code {pdflatex_result.returncode}"
-            )
-
-        # Create the index files.
-        for sxd in Path.glob(build_dir, "*.sxd"):
-            logging.debug(f"Creating index file for {sxd}")
-            self._make_latex_index(sxd)
+        self._run_latex_tool(
+            pdflatex_args, build_dir, "pdflatex rerun" if rerun else "pdflatex"
+        )
 
-        # Rerun pdflatex now that we have indices
-        pdflatex_result = subprocess.run(pdflatex_args, cwd=build_dir)
-        if pdflatex_result.returncode != 0:
+    def _run_latex_tool(self, args: list, build_dir: Path, description: str):
+        """Run a LaTeX tool in the build directory.
+        The tools print a lot of progress output, so their output is discarded
+        rather than written to the terminal. Details of any failure are in the
+        log files the tools write to the build directory."""
+        logging.debug(f"Running {args[0]} with args: {args}")
+        result = subprocess.run(
+            args,
+            cwd=build_dir,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            close_fds=False,
+        )
+        if result.returncode != 0:
+            if result.stderr:
+                logging.error(result.stderr.decode(errors="replace"))
             raise RuntimeError(
-                f"pdflatex rerun failed with return code {pdflatex_result.returncode}"
+                f"{description} failed with return code {result.returncode}. "
+                f"See the log files in {build_dir} for details."
             )
 
-        # Copy the output file to the output directory
-        shutil.copy(
-            build_dir.joinpath(Path(output_filename).stem + ".pdf"),
-            output_dir,
+    def _build_template_vars(self, config: dict) -> dict:
+        """Get the variables used to render the templates for an output format.
+        Later sources take precedence: the format config, then its
+        render_variables, then the songbook config, then the sections. The
+        sources are merged once per format into a plain dict, which Jinja2
+        copies cheaply for each template it renders."""
+        template_vars = dict(
+            ChainMap(
+                {"sections": self.sections},
+                self.songbook_config,
+                config.get("render_variables", {}),
+                config,
+            )
         )
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for var in template_vars:
+                logging.debug(f"Template variable {var}: {template_vars[var]}")
+        return template_vars
+
+    def _get_jinja_env(self, template_dir: Path) -> "jinja2.Environment":
+        """Get the Jinja2 environment for the given template directory.
+        Environments are shared between output formats, so each template is
+        only compiled once. Compiled templates are also cached in the build
+        directory, so they are reused across runs."""
+        import jinja2
+
+        template_dir = Path(template_dir)
+        if template_dir not in self._jinja_envs:
+            cache_dir = self.build_root.joinpath(".jinja_cache")
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self._jinja_envs[template_dir] = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(template_dir),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir),
+                auto_reload=False,
+            )
+        return self._jinja_envs[template_dir]
+
+    def _render_template(self, template: Path, variables: Mapping = None) -> str | None:
+        """Render the given template.
+        Returns None if the template uses a variable that isn't defined."""
+        import jinja2
 
-    def _render_template(self, template: str, build_dir: Path, variables: dict = None):
-        """Render the given template and copy the result to the build directory."""
         # Load the template
         template = Path(template)
-        output_file = build_dir.joinpath(template.name)
-        logging.debug(f"Rendering template {template} to {output_file}")
-        with open(template, "r") as template_file:
-            template = jinja2.Template(template_file.read())
+        logging.debug(f"Rendering template {template}")
+        template = self._get_jinja_env(template.parent).get_template(template.name)
 
         # Render the template
         try:
-            rendered = template.render(variables)
+            return template.render(variables)
         except jinja2.exceptions.UndefinedError as e:
             # Either there is a real problem, or the variable isn't defined for
             # a template we aren't using. Log a warning and continue.
             logging.warning(f"Undefined variable in template {template}: {e}")
-            return
-
-        # Write the rendered template to the build directory
-        with open(output_file, "w") as output:
-            output.write(rendered)
+            return None
 
     def make_epub_output(self, epub_config: dict):
         """Create EPUB output, using tex4ebook to convert the LaTeX to HTML."""
-        # Create the output and build directories
+        # Create the output directory
         output_dir = self.output_dir.joinpath(epub_config["output_dir"])
         output_dir.mkdir(parents=True, exist_ok=True)
-        build_dir = self.build_root.joinpath(epub_config["output_dir"])
-        build_dir.mkdir(parents=True, exist_ok=True)
-
-        # Render the template files and copy the result to the build directory.
-        template_vars = (
-            epub_config
-            | epub_config.get("render_variables", {})
-            | self.songbook_config
-            | {"sections": self.sections}
-        )
-        for var in template_vars:
-            logging.debug(f"Template variable {var}: {template_vars[var]}")
-
-        # Render all the templates from the template directory to the build directory.
-        # Get a list of all of the files in the template directory, excluding the
-        # style file.
-        template_dir = self.base_path.joinpath(epub_config["template_dir"])
-        template_files = listdir(template_dir)
-        logging.debug(f"Template files: {template_files}")
-        template_files = [
-            Path(template_dir).joinpath(f)
-            for f in template_files
-            if Path(f).name != Path(epub_config["songbook_style"]).name
-        ]
-        for template in template_files:
-            self._render_template(
-                template,
-                build_dir,
-                template_vars,
-            )
-
-        # Copy the songs.sty file to the build directory
-        shutil.copy(
-            self.base_path.joinpath(epub_config["songbook_style"]),
-            build_dir,
-        )
 
-        # Copy the images directory to the build directory, if present.
-        if "image_dir" in epub_config:
-            shutil.copytree(
-                self.base_path.joinpath(epub_config["image_dir"]),
-                build_dir.joinpath(epub_config["image_dir"]),
-                dirs_exist_ok=True,
-            )
-
-        # Create the SBD file from the input files.
-        self._make_songfile(build_dir, epub_config)
         # Get the output filename, without the extension.
         output_filename = (
             (epub_config["output_file"])
@@ -329,57 +519,45 @@ class SongBookMaker:
             else epub_config["songbook_template"]
         ).split(".")[0]
 
-        # Run pdflatex on the main file to create the sxd files.
-        pdflatex_args = [
-            "pdflatex",
-            f"-jobname={output_filename}",
-            "-halt-on-error",
-            Path(epub_config["songbook_template"]).name,
-        ]
-        logging.debug(f"Running pdflatex with args: {pdflatex_args}")
-        pdflatex_result = subprocess.run(pdflatex_args, cwd=build_dir)
-        if pdflatex_result.returncode != 0:
-            raise RuntimeError(
-                f"pdflatex failed with return code {pdflatex_result.returncode}"
-            )
-
-        # Create the index files.
-        for sxd in Path.glob(build_dir, "*.sxd"):
-            logging.debug(f"Creating index file for {sxd}")
-            self._make_latex_index(sxd)
-
-        latex_args = [
-            "tex4ebook",
-            "--output-dir",
-            build_dir,
-            "--format",
-            "epub",
-            "--jobname",
+        # Prepare the LaTeX build.
+        build_dir, fingerprint = self._prepare_latex_build(
+            self.build_root.joinpath(epub_config["output_dir"]),
+            epub_config,
             output_filename,
-            Path(epub_config["songbook_template"]).name,
-        ]
-        # Run tex4ebook  now that we have indices
-        latex_result = subprocess.run(latex_args, cwd=build_dir)
-        if latex_result.returncode != 0:
-            raise RuntimeError(
-                f"tex4ebook run failed with return code {latex_result.returncode}"
-            )
+        )
+        output_file = build_dir.joinpath(
+            Path(output_filename).stem + "-epub",
+            output_filename + ".epub",
+        )
+
+        if self._latex_build_is_current(build_dir, fingerprint, output_file):
+            logging.info(f"{output_file} is up to date, skipping tex4ebook")
+        else:
+            # Create the indices, then run tex4ebook now that we have them.
+            self._make_latex_index_pass(build_dir, epub_config, output_filename)
+            latex_args = [
+                "tex4ebook",
+                "--output-dir",
+                build_dir,
+                "--format",
+                "epub",
+                "--jobname",
+                output_filename,
+                Path(epub_config["songbook_template"]).name,
+            ]
+            self._run_latex_tool(latex_args, build_dir, "tex4ebook run")
+            self._save_latex_build_fingerprint(build_dir, fingerprint, output_file)
 
         # Copy the output file to the output directory
-        shutil.copy(
-            build_dir.joinpath(
-                Path(output_filename).stem + "-epub",
-                output_filename + ".epub",
-            ),
-            output_dir,
-        )
+        fast_copy(output_file, output_dir)
 
     def _make_songfile(self, build_dir: Path, config: dict):
         """Create the SBD file from the input files."""
         logging.debug(f"Creating SBD file in {build_dir}")
         # Create the SBD file from the input files.
         songfile = build_dir.joinpath(self.songfile)
-        with open(songfile, "w") as output:
+        # Songs are written in many small pieces, so use a larger write buffer.
+        with open(songfile, "w", buffering=SONGFILE_BUFFER_SIZE) as output:
             # Add the sbd header from the render_variables, if present
             if "sbd_header" in config:
                 output.write(config["sbd_header"])
@@ -387,138 +565,174 @@ class SongBookMaker:
             # Add the section input files
             for section_name, section in self.sections.items():
                 output.write(
-                    r"\begin{songs}{"
-                    + section_name.replace(" ", "_")
-                    + "_idx"
-                    + ","
-                    + r"authoridx}"
-                    + "\n"
+                    "".join(
+                        [
+                            r"\begin{songs}{",
+                            section_name.replace(" ", "_"),
+                            "_idx,",
+                            r"authoridx}",
+                            "\n",
+                            f"\\songchapter{{{section_name}}}\n",
+                        ]
+                    )
                 )
-                output.write(f"\\songchapter{{{section_name}}}\n")
                 for input_file in section["files"]:
                     logging.debug(f"Adding {input_file} to SBD file.")
-                    xml = Path(input_file).read_text()
-                    text = self._xml_to_sbd(xml)
+                    text = self.parsed_cache.get(input_file)
+                    if text is None:
+                        try:
+                            xml = Path(input_file).read_bytes()
+                        except FileNotFoundError as e:
+                            raise FileNotFoundError(
+                                f"Input file not found: {e.filename}"
+                            ) from e
+                        text = self._xml_to_sbd(xml, input_file)
+                        self.parsed_cache[input_file] = text
                     if not text:
                         logging.error(f"Failed to convert {input_file} to SBD.")
                         continue
                     output.write(text)
                 output.write(r"\end{songs}")
 
-    def _xml_to_sbd(self, xml_string: str) -> str:
-        """Convert an XML string to an LaTeX songs entry.
-        This is done by parsing the XML and then converting it to LaTeX tags."""
+    @cached_property
+    def _song_parser(self):
+        """Parser for song files. Comments and processing instructions are
+        dropped while parsing, so only elements need to be handled when walking
+        the tree."""
+        from lxml import etree
+
+        return etree.XMLParser(
+            huge_tree=True, collect_ids=False, remove_comments=True, remove_pis=True
+        )
+
+    @cached_property
+    def _lines_xp(self):
+        """Precompiled XPath expression for finding the lines of a verse."""
+        from lxml import etree
 
-        # First, parse the XML string into an XML tree.
-        # This is done by converting the string to bytes and then parsing it.
-        # This is necessary because the XML parser expects bytes, not a string.
-        xml_bytes = xml_string.encode("utf-8")
-        xml_tree = ET.fromstring(xml_bytes)
+        return etree.XPath(".//ol:lines", namespaces=OL_NS)
+
+    def _xml_to_sbd(self, xml_bytes: bytes, source: Path = None) -> str:
+        """Convert an XML document to an LaTeX songs entry.
+        This is done by parsing the XML and then converting it to LaTeX tags.
+        source is the file the XML was read from, and is only used in error
+        messages."""
+        from lxml import etree
+
+        # First, parse the XML into an XML tree. The raw bytes are parsed
+        # directly, so the parser can honour the encoding in the XML declaration.
+        xml_tree = etree.fromstring(xml_bytes, parser=self._song_parser)
 
         # Get the properties from the XML tree.
-        ns = {"ol": "http://openlyrics.info/namespace/2009/song"}
         song_header = {}
-        properties = xml_tree.find(".//ol:properties", ns)
+        properties = xml_tree.find(".//ol:properties", OL_NS)
         if properties is not None:
             # Walk the song header, getting the known tags
             multitags = {"titles", "authors", "keywords", "themes"}
             single_tags = {"ccliNo", "verseOrder", "copyright", "tune"}
             for child in properties:
-                # Check if the tag is a known tag, removing the namespace, if present.
-                if "}" in child.tag:
-                    child.tag = child.tag.split("}")[1]
-                if child.tag in multitags:
-                    if child.tag not in song_header:
-                        song_header[child.tag] = []
+                # Check if the tag is a known tag, ignoring the namespace.
+                tag = etree.QName(child).localname
+                if tag in multitags:
+                    if tag not in song_header:
+                        song_header[tag] = []
                     for grandchild in child:
-                        song_header[child.tag].append(grandchild.text)
-                elif child.tag in single_tags:
-                    song_header[child.tag] = child.text
+                        song_header[tag].append(grandchild.text)
+                elif tag in single_tags:
+                    song_header[tag] = child.text
                 else:
-                    logging.debug(f"Unknown tag {child.tag} in song header.")
+                    logging.debug(f"Unknown tag {tag} in song header.")
         else:
-            logging.error(f"No properties found for XML {xml_string}.")
+            logging.error(f"No properties found in {source}.")
             return ""
         if "titles" not in song_header:
-            logging.error(f"No title found for XML {xml_string}.")
+            logging.error(f"No title found in {source}.")
             return ""
 
-        # Create the LaTeX entry
-        entry = "\\beginsong{" + song_header["titles"][0] + "}[\n"
+        # Create the LaTeX entry. The pieces are collected in a list and joined
+        # once at the end.
+        parts = ["\\beginsong{", song_header["titles"][0], "}[\n"]
         if "authors" in song_header:
-            entry += "by={" + ", ".join(song_header["authors"]) + "},\n"
+            parts += ["by={", ", ".join(song_header["authors"]), "},\n"]
         if "keywords" in song_header:
-            entry += "index={" + ", ".join(song_header["keywords"]) + "},\n"
+            parts += ["index={", ", ".join(song_header["keywords"]), "},\n"]
         if "copyright" in song_header:
-            entry += "cr={" + song_header["copyright"] + "},\n"
+            parts += ["cr={", song_header["copyright"], "},\n"]
         if "tune" in song_header:
-            entry += "tune={" + song_header["tune"] + "},\n"
-        entry += "]\n\n"
+            parts += ["tune={", song_header["tune"], "},\n"]
+        parts.append("]\n\n")
 
         # Check if there is a comment element before the first verse and add it.
         # Walk the tree until we find the first verse.
         # If we find a comment element, add it to the entry.
         for child in xml_tree:
-            if "}" in child.tag:
-                child.tag = child.tag.split("}")[1]
-            if child.tag == "verse":
+            tag = etree.QName(child).localname
+            if tag == "verse":
                 break
-            if child.tag == "comment":
-                entry += f"\\textnote{{{child.text}}}\n\n"
+            if tag == "comment":
+                parts.append(f"\\textnote{{{child.text}}}\n\n")
+
+        # Collect the verses by name in a single walk of the tree. If a name is
+        # repeated, the first verse with that name is used.
+        verse_order = []
+        verses_by_name = {}
+        for verse in xml_tree.iter(f"{{{OL_NAMESPACE}}}verse"):
+            verse_order.append(verse.attrib["name"])
+            verses_by_name.setdefault(verse.attrib["name"], verse)
 
         # Add the verses and choruses, in verseOrder is present.
         # Otherwise add them in XML order.
         if "verseOrder" in song_header:
             verse_order = song_header["verseOrder"].split()
-        else:
-            # Get all verse numbers
-            verse_order = []
-            for verse in xml_tree.findall(".//ol:verse", ns):
-                verse_order.append(verse.attrib["name"])
         for verse_number in verse_order:
-            if verse_number.lower().startswith("c"):
-                entry += f"\\beginchorus\n"
-            else:
-                entry += f"\\beginverse\n"
-            verse = xml_tree.find(f".//ol:verse[@name='{verse_number}']", ns)
+            is_chorus = verse_number[:1] in ("c", "C")
+            parts.append(BEGIN_CHORUS if is_chorus else BEGIN_VERSE)
+            verse = verses_by_name[verse_number]
             # Each verse consists of one or more lines of text, which may be
             # interspersed with chords and other tags.
-            lines = verse.findall(".//ol:lines", ns)
+            lines = self._lines_xp(verse)
             for line in lines:
                 # Each line consists of one or more text elements, which may be
                 # interspersed with chords and other tags.
                 # The text elements are joined together, and then the chords are
                 # interspersed.
-                line_text = line.text.strip() if line.text else ""
+                if line.text:
+                    parts.append(line.text.strip())
                 for item in line:
-                    # Remove the namespace from the tag, if present
-                    if "}" in item.tag:
-                        item.tag = item.tag.split("}")[1]
-                    if item.tag == "comment":
-                        line_text += f"\\textnote{{{item.text}}}"
-                    if item.tag == "chord":
+                    # Compare tags without the namespace
+                    tag = etree.QName(item).localname
+                    if tag == "comment":
+                        parts.append(f"\\textnote{{{item.text}}}")
+                    if tag == "chord":
                         # Add the chord, if present. OpenLyrics uses the root attribute
                         # for the chord, plus on optional structure attribute for the chord type.
                         chord = item.attrib["root"].replace("&", "b")
                         if "structure" in item.attrib:
                             chord += item.attrib["structure"]
-                        line_text += f" \\[{chord}]"
-                    if item.tag == "br":
-                        line_text += "\n"
+                        parts.append(f" \\[{chord}]")
+                    if tag == "br":
+                        parts.append("\n")
                     if item.tail:
                         if "\n" in item.tail:
                             text = "\n" + item.tail.strip() + "\n"
                         else:
                             text = item.tail.strip()
-                        line_text += text.rstrip()
-
-                entry += line_text
-            if verse_number.lower().startswith("c"):
-                entry += "\n\\endchorus\n"
-            else:
-                entry += "\n\\endverse\n"
-        entry += "\\endsong\n\n"
-        return entry
+                        parts.append(text.rstrip())
+            parts.append(END_CHORUS if is_chorus else END_VERSE)
+        parts.append(END_SONG)
+        return "".join(parts)
+
+    def _make_latex_indices(self, build_dir: Path):
+        """Create index files for all of the SXD files in the build directory.
+        Each index is independent, so they are created concurrently."""
+        with os.scandir(build_dir) as entries:
+            sxd_files = [
+                Path(entry.path) for entry in entries if entry.name.endswith(".sxd")
+            ]
+        logging.debug(f"Creating index files for {sxd_files}")
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Consume the results so that any exceptions are raised here.
+            list(executor.map(self._make_latex_index, sxd_files))
 
     def _make_latex_index(self, sxd_file: Path | str):
         """Create an index file for the given SXD file."""
@@ -551,7 +765,7 @@ class SongBookMaker:
                 # '~' or '\ ' may have been used to replace spaces to prevent name breaking
                 for name in [
                     x
-                    for x in re.split(" and |[^a-zA-Z~. ]+", author.replace("\\ ", "~"))
+                    for x in AUTHOR_SPLIT_RE.split(author.replace("\\ ", "~"))
                     if x != ""
                 ]:
                     try:
@@ -562,39 +776,23 @@ class SongBookMaker:
                         entry = ", ".join([last.strip(), first.strip()]).replace(
                             "~", " "
                         )
-                    # add to the dictionary
-                    # {'Doe, John': [{'num': '1', 'link': 'song1-1.1'}, etc...]}
+                    # add to the dictionary, converting the song number once
+                    # here so that it can be sorted on directly.
+                    # {'Doe, John': [SongRef(songnum=1, link='song1-1.1'), etc...]}
                     try:
-                        authors[entry].append({"songnum": songnum, "link": link})
+                        authors[entry].append(SongRef(int(songnum), link))
                     except KeyError:
-                        authors[entry] = [{"songnum": songnum, "link": link}]
+                        authors[entry] = [SongRef(int(songnum), link)]
         with open(sbx_file, "w") as sbx:
-            # setup some formatting string constants
-            beginsection = "\\begin{{idxblock}}{{}}\n"
-            endsection = "\\end{{idxblock}}\n"
-            auth_entry = "\\idxentry{{{author}}}{{"
-            song_entry = "\\songlink{{{link}}}{{{songnum}}}"
-            sbx.write(beginsection.format())
+            sbx.write("\\begin{idxblock}{}\n")
             for author in sorted(authors, key=str.casefold):
-                # write author entry
-                sbx.write(auth_entry.format(author=author))
-                # write first song entry
-                songs = authors[author]
-                songs.sort(key=lambda k: int(k["songnum"]))
-                sbx.write(
-                    song_entry.format(
-                        songnum=songs[0]["songnum"], link=songs[0]["link"]
-                    )
+                # write the author entry, with its songs in song number order
+                songs = sorted(authors[author], key=SONG_KEY)
+                song_links = "\\\\".join(
+                    f"\\songlink{{{song.link}}}{{{song.songnum}}}" for song in songs
                 )
-                # write subsequent song entries
-                for song in songs[1:]:
-                    sbx.write("\\\\")
-                    sbx.write(
-                        song_entry.format(songnum=song["songnum"], link=song["link"])
-                    )
-                # and end the line
-                sbx.write("}\n")
-            sbx.write(endsection.format())
+                sbx.write(f"\\idxentry{{{author}}}{{{song_links}}}\n")
+            sbx.write("\\end{idxblock}\n")
 
     def _make_latex_title_index(
         self, sxd_file: str, sbx_file: str, letterblock: bool = True
@@ -625,42 +823,79 @@ class SongBookMaker:
                         title = ", ".join([end, begin])
                 # capitalize just the first letter of the first word
                 title = title[0].upper() + title[1:]
-                # make into a dictionary and add the song to the song list
-                titles.append(
-                    {"title": title, "songnum": songnum, "link": link, "alt": alt}
-                )
-        titles.sort(key=lambda k: k["title"].casefold())
+                # add the song to the song list
+                titles.append(TitleRef(title, songnum, link, alt))
+        titles.sort(key=lambda t: t.title.casefold())
 
         # setup some formatting string constants
-        beginsection = "\\begin{{idxblock}}{{{}}}\n"
-        endsection = "\\end{{idxblock}}\n"
-        entry = "\\{linktype}{{{title}}}{{\\songlink{{{link}}}{{{songnum}}}}}\n"
+        endsection = "\\end{idxblock}\n"
 
         # write out the index file
         with open(sbx_file, "w") as f:
             if letterblock:
-                section = titles[0]["title"][0]
-                f.write(beginsection.format(section))
+                section = titles[0].title[0]
+                f.write(f"\\begin{{idxblock}}{{{section}}}\n")
             for song in titles:
                 if letterblock:  # check for a new index section
-                    if song["title"][0].casefold() != section.casefold():
-                        f.write(endsection.format())  # close out old block
-                        section = song["title"][0].upper()
-                        f.write(beginsection.format(section))
-                if song["alt"]:  # check for alternate title
+                    if song.title[0].casefold() != section.casefold():
+                        f.write(endsection)  # close out old block
+                        section = song.title[0].upper()
+                        f.write(f"\\begin{{idxblock}}{{{section}}}\n")
+                if song.alt:  # check for alternate title
                     linktype = "idxaltentry"
                 else:
                     linktype = "idxentry"
                 f.write(
-                    entry.format(
-                        linktype=linktype,
-                        title=song["title"],
-                        link=song["link"],
-                        songnum=song["songnum"],
-                    )
+                    f"\\{linktype}{{{song.title}}}"
+                    f"{{\\songlink{{{song.link}}}{{{song.songnum}}}}}\n"
                 )
             if letterblock:
-                f.write(endsection.format())  # close out final block
+                f.write(endsection)  # close out final block
+
+
+def fast_copy(src: str | Path, dst: str | Path) -> Path:
+    """Copy a file, including its metadata, like shutil.copy2.
+    The data is copied in the kernel with copy_file_range where possible,
+    which can reflink the file on btrfs and XFS. Otherwise shutil.copyfile is
+    used, which already uses sendfile on Linux. If dst is a directory, the
+    file is copied into it. Can be used as the copy_function for
+    shutil.copytree."""
+    src = Path(src)
+    dst = Path(dst)
+    if dst.is_dir():
+        dst = dst.joinpath(src.name)
+    if dst.exists() and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f"{src} and {dst} are the same file")
+    if not _copy_file_range(src, dst):
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _copy_file_range(src: Path, dst: Path) -> bool:
+    """Copy src to dst with copy_file_range. Returns False if it can't be used
+    for these files, in which case dst may be partially written."""
+    if not hasattr(os, "copy_file_range"):
+        return False
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if size == 0:
+            # Empty, or a special file that doesn't report its size.
+            return False
+        copied = 0
+        try:
+            while copied < size:
+                sent = os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), min(size - copied, COPY_BUFFER_SIZE)
+                )
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError as e:
+            # Not supported for this kind of file, or across these filesystems.
+            logging.debug(f"Unable to copy {src} with copy_file_range: {e}")
+            return False
+    return copied == size
 
 
 def get_file_list(input: list[str | Path], base_path: Path = None) -> list[Path]:
@@ -675,51 +910,118 @@ def get_file_list(input: list[str | Path], base_path: Path = None) -> list[Path]
     files = []
     for f in input:
         if f.is_dir():
-            files.extend([f.joinpath(file) for file in listdir(f)])
+            with os.scandir(f) as entries:
+                files.extend(Path(entry.path) for entry in entries)
         else:
             files.append(f)
     return files
 
 
-def load_config(config_file: str) -> dict:
-    """Load config file and verify that all required fields are present."""
+def load_section(name: str, settings: dict, base_path: Path = None) -> dict:
+    """Load a section from the config file, getting the list of its files."""
+    logging.debug(f"Section {name}: {settings}")
+    intro_file = settings.get("intro_file")
+    return {
+        "intro_file": (
+            (base_path / intro_file if base_path is not None else Path(intro_file))
+            if intro_file
+            else None
+        ),
+        "files": get_file_list(settings["files"], base_path),
+        "sort": settings.get("sort"),
+    }
+
+
+def load_config(config_file: str | Path) -> dict:
+    """Load config file and verify that all required fields are present.
+    Validated configs are cached, and the cached copy is used for as long as
+    neither the config file nor this program has changed."""
+    config_file = Path(config_file)
+    stat = config_file.stat()
+    # The validation rules live in this file, so any change to it invalidates
+    # the cache.
+    code_stat = os.stat(__file__)
+    code_version = (code_stat.st_mtime_ns, code_stat.st_size)
+    cache_file = CONFIG_CACHE_DIR.joinpath(
+        hashlib.blake2b(str(config_file.resolve()).encode()).hexdigest() + ".pkl"
+    )
+    try:
+        with open(cache_file, "rb") as cache:
+            cached = pickle.load(cache)
+    except FileNotFoundError:
+        pass
+    except (
+        OSError,
+        EOFError,
+        ValueError,
+        TypeError,
+        AttributeError,
+        ImportError,
+        pickle.UnpicklingError,
+    ) as e:
+        logging.debug(f"Ignoring unreadable config cache {cache_file}: {e}")
+    else:
+        # The cache is only trusted if it has the expected shape, so a
+        # damaged or foreign cache file is simply ignored.
+        if (
+            isinstance(cached, tuple)
+            and len(cached) == 4
+            and isinstance(cached[3], dict)
+            and cached[:3] == (code_version, stat.st_mtime_ns, stat.st_size)
+        ):
+            logging.debug(f"Using cached config {cache_file}")
+            return cached[3]
+        logging.debug(f"Ignoring stale config cache {cache_file}")
+
     with open(config_file, "rb") as config_file:
-        config = tomli.load(config_file)
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+
+        config = tomllib.load(config_file)
 
     # Check that all required fields are present
-    required_fields = [
-        "songbook",
-        "output_formats",
-    ]
-    for field in required_fields:
-        if field not in config:
-            raise ValueError(f"Missing required field in config file: {field}")
+    missing = REQUIRED_CONFIG_FIELDS - config.keys()
+    if missing:
+        raise ValueError(f"Missing required fields in config file: {sorted(missing)}")
 
     # Check that all output formats are valid
-    format_type_options = {
-        "html": ["template", "output_dir", "output_file"],
-        "pdf": ["output_dir", "output_file"],
-        "epub": ["output_dir", "output_file"],
-    }
     for format_name, settings in config["output_formats"].items():
-        if settings["type"] not in format_type_options:
+        if settings["type"] not in FORMAT_REQUIRED_FIELDS:
             raise ValueError(f"Invalid output format: {settings['type']}")
-        for field in format_type_options[settings["type"]]:
-            if field not in settings:
-                raise ValueError(
-                    f"Missing required field for format_name: {settings['type']}: {field}"
-                )
+        missing = FORMAT_REQUIRED_FIELDS[settings["type"]] - settings.keys()
+        if missing:
+            raise ValueError(
+                f"Missing required fields for {format_name} ({settings['type']}): "
+                f"{sorted(missing)}"
+            )
+
+    # Cache the validated config. The cache is only an optimization, so
+    # failing to write it isn't an error.
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, "wb") as cache:
+            pickle.dump(
+                (code_version, stat.st_mtime_ns, stat.st_size, config),
+                cache,
+                protocol=5,
+            )
+    except OSError as e:
+        logging.debug(f"Unable to write config cache {cache_file}: {e}")
 
     return config
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("config", type=str, default="config.toml", help="Config file.")
+    parser.add_argument(
+        "config", type=Path, default=Path("config.toml"), help="Config file."
+    )
     parser.add_argument(
         "--output",
-        type=str,
-        default="output",
+        type=Path,
+        default=Path("output"),
         help="Top level output directory. (default: %(default)s))",
     )
     parser.add_argument(
@@ -744,28 +1046,32 @@ if __name__ == "__main__":
     # Parse config file
     config = load_config(args.config)
 
-    # Get base path for input files
-    base_path = Path(args.config).parent
-
-    # Get the list of sections to include.
-    sections = {}
-    if "sections" in config:
-        for section, settings in config["sections"].items():
-            logging.debug(f"Section {section}: {settings}")
-            sections[section] = {}
-            if "intro_file" in settings and settings["intro_file"] is not None:
-                sections[section]["intro_file"] = Path(settings["intro_file"])
-            sections[section]["files"] = get_file_list(settings["files"], base_path)
-            sections[section]["sort"] = settings.get("sort", None)
-            # Check that all input files exist
-            for f in sections[section]["files"]:
-                if not f.exists():
-                    raise FileNotFoundError(f"Input file not found: {f}")
+    # Get base path for input files. This is resolved once here, so that all
+    # of the paths built from it are already absolute.
+    base_path = args.config.resolve().parent
+
+    # Get the list of sections to include. Listing the files of each section
+    # is I/O bound, so the sections are loaded concurrently.
+    section_settings = config.get("sections", {})
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(MAX_WORKERS, len(section_settings)))
+    ) as executor:
+        sections = dict(
+            zip(
+                section_settings,
+                executor.map(
+                    load_section,
+                    section_settings,
+                    section_settings.values(),
+                    [base_path] * len(section_settings),
+                ),
+            )
+        )
 
     maker = SongBookMaker(
         songbook_config=config["songbook"],
         sections=sections,
-        output_dir=base_path.joinpath(args.output),
+        output_dir=base_path / args.output,
         output_formats=config["output_formats"],
         base_path=base_path,
         clean=args.clean,